@@ -32,16 +32,83 @@ Utilidad con fines docentes
 Universidad de Vigo"""
 
 # se cargan los módulos que se van a emplear
+import math
+from functools import lru_cache
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.stats as st
 import scipy.special as sp
 
+# ln(10), para evaluar 10**x como exp(x * ln(10))
+_LN10 = math.log(10)
+
+# distancias por defecto para la tabla de cargas de cargas_sd (solo lectura)
+_DEFAULT_D_GRID = np.linspace(50.0, 250.0, 20)
+_DEFAULT_D_GRID.setflags(write=False)
+
 ''''""""""""""""""""""""""""""""""""""""'''
 
 
-def ppv_regress(filename, nc=0.9, cobertura=0.95, ngrid=20):
+# cuantiles y matrices que solo dependen de (nc, n, cobertura) o del grid: se
+# guardan en caché para las llamadas repetidas a ppv_regress
+@lru_cache(maxsize=128)
+def _t_ppf(p, df):
+    """
+    Quantile p of the Student t distribution with df degrees of freedom
+    (scipy.special.stdtrit, without the input validation of scipy.stats.t.ppf).
+    """
+    return sp.stdtrit(df, p)
+
+
+@lru_cache(maxsize=128)
+def _norm_ppf(p):
+    """
+    Quantile p of the standard normal distribution (scipy.special.ndtri,
+    without the input validation of scipy.stats.norm.ppf).
+    """
+    return sp.ndtri(p)
+
+
+@lru_cache(maxsize=128)
+def _vander_fit(x_min, x_max, ngrid):
+    """
+    Returns the (3, ngrid) matrix (V^T V)^-1 V^T, with V the Vandermonde
+    matrix of the grid np.linspace(x_min, x_max, ngrid), that maps values on
+    the grid to the coefficients of their least-squares quadratic fit.
+    """
+    v_grid = np.vander(np.linspace(x_min, x_max, ngrid), 3)
+    fit = np.linalg.solve(v_grid.T @ v_grid, v_grid.T)
+    fit.setflags(write=False)
+    return fit
+
+
+def _leverage(x_arr, x_mean, ss, n):
+    """
+    Returns the leverage term h = 1/n + (x - x_mean)^2/ss of the linear
+    regression at the points x_arr, shared by the prediction and tolerance
+    intervals.
+    """
+    d = x_arr - x_mean
+    np.multiply(d, d, out=d)
+    np.divide(d, ss, out=d)
+    np.add(d, 1.0 / n, out=d)
+    return d
+
+
+def _error_terms(x_arr, x_mean, ss, n, k_pred):
+    """
+    Returns the prediction error sqrt(1 + h) * k_pred and the tolerance
+    factor sqrt(h), with h the leverage term.
+    """
+    h = _leverage(x_arr, x_mean, ss, n)
+    x_tol = np.sqrt(h)
+    se = np.sqrt(np.add(h, 1.0, out=h), out=h)
+    np.multiply(se, k_pred, out=se)
+    return se, x_tol
+
+
+def ppv_regress(
+    filename, nc=0.9, cobertura=0.95, ngrid=20, plot=True, compute_tolerance=True
+):
     """
     Calculates the linear regression of the sample (x, y) --> (log_s_d, log_v_e),
     the prediction intervals with a confidence level nc (with nc > 0.5) at the
@@ -53,11 +120,14 @@ def ppv_regress(filename, nc=0.9, cobertura=0.95, ngrid=20):
     nc (float): Confidence level for prediction intervals (default is 0.9).
     cobertura (float): Coverage for tolerance intervals (default is 0.95).
     ngrid (int) : Number of points in the grid (default is 20).
+    plot (bool): Whether to plot the results (default is True).
+    compute_tolerance (bool): Whether to compute the tolerance interval (default is True).
     Returns:
     tuple: Contains the following elements:
         - nc_equation_pred (np.ndarray): Coefficients of the quadratic fit for the prediction interval (nc).
         - nc_equation_aprox (tuple): Intercept and slope for the approximate method.
-        - nc_equation_tol (np.ndarray): Coefficients of the quadratic fit for the tolerance interval (nc).
+        - nc_equation_tol (np.ndarray): Coefficients of the quadratic fit for the tolerance interval (nc),
+          or None if compute_tolerance is False.
     Raises:
     FileNotFoundError: If the input file is not found.
     ValueError: If the input file does not contain 'x' and 'y' columns.
@@ -73,9 +143,18 @@ def ppv_regress(filename, nc=0.9, cobertura=0.95, ngrid=20):
 
     # lectura de los datos en fichero de texto con valores (x, y)
     try:
-        df_x = pd.read_csv(filename, sep=r"\s+")
-        if "x" not in df_x.columns or "y" not in df_x.columns:
-            raise ValueError("Input file must contain 'x' and 'y' columns.")
+        # utf-8-sig: como pd.read_csv, admite ficheros con BOM (Bloc de notas, Excel)
+        with open(filename, encoding="utf-8-sig") as f:
+            columns = f.readline().split()
+            if "x" not in columns or "y" not in columns:
+                raise ValueError("Input file must contain 'x' and 'y' columns.")
+            x, y = np.loadtxt(
+                f,
+                dtype=np.float64,
+                usecols=(columns.index("x"), columns.index("y")),
+                unpack=True,
+                ndmin=2,
+            )
     except FileNotFoundError:
         print(f"Error: The file {filename} was not found.")
         return
@@ -83,96 +162,130 @@ def ppv_regress(filename, nc=0.9, cobertura=0.95, ngrid=20):
         print(f"Error: {e}")
         return
 
-    x = df_x["x"]
-    y = df_x["y"]
+    # todos los cálculos se hacen sobre arrays contiguos (np.loadtxt con
+    # unpack=True devuelve vistas con salto entre elementos)
+    x = np.ascontiguousarray(x)
+    y = np.ascontiguousarray(y)
 
     # número de datos del registro y el grid de puntos
-    n = len(x)
-    x_grid = np.linspace(np.min(x), np.max(x), ngrid)
+    n = x.size
+    x_grid = np.linspace(x.min(), x.max(), ngrid)
+
+    # regresión lineal por mínimos cuadrados (forma cerrada); x_mean y ss se
+    # emplean también en el cálculo del error total en cada punto
+    x_mean = np.mean(x)
+    y_mean = np.mean(y)
+    x_gap = x - x_mean
+    y_gap = y - y_mean
+    ss = x_gap @ x_gap
+    slope = (x_gap @ y_gap) / ss
+    intercept = y_mean - slope * x_mean
 
-    # regresión lineal, predicción (valor esperado), residuos y su desviación estándar
-    slope, intercept = np.polyfit(x, y, deg=1)
+    # predicción (valor esperado), residuos y su desviación estándar
     y_predict = intercept + slope * x
     rss_y = y - y_predict
-    mse = np.sqrt(np.square(rss_y).sum() / (n - 2))
+    mse = math.sqrt(rss_y @ rss_y / (n - 2))
 
-    # cálculos intermedios para obtener el error total en cada punto
-    x_mean = np.mean(x)
-    x_gap = x - x_mean
-    ss = np.square(x_gap).sum()
+    # cuantiles de las distribuciones t y normal: se calculan una única vez
+    t_crit = _t_ppf(nc, n - 2)
+    z_cov = _norm_ppf(cobertura)
+    se_x_aprox = _norm_ppf(nc) * mse
+    # factor de escala común del error de predicción en x y x_grid
+    k_pred = mse * t_crit
 
     # cálculo del error (en puntos x y x_grid): método aproximado y riguroso
     # (teniendo en cuenta el error del modelo) e intervalo de tolerancia
-    se_x_aprox = st.norm.ppf(nc, loc=0, scale=mse)
-    se_x = (
-        np.sqrt(1 + 1 / n + np.square((x - x_mean)) / ss) * mse * st.t.ppf(nc, df=n - 2)
-    )
-    se_x_grid = (
-        np.sqrt(1 + 1 / n + np.square((x_grid - x_mean)) / ss)
-        * mse
-        * st.t.ppf(nc, df=n - 2)
-    )
+    # el término de apalancamiento h = 1/n + (x - x_mean)^2/ss da, en una sola
+    # pasada, el error de predicción y el factor del intervalo de tolerancia
+    se_x, _x_tol = _error_terms(x, x_mean, ss, n, k_pred)
+    se_x_grid, _x_tol_grid = _error_terms(x_grid, x_mean, ss, n, k_pred)
 
-    # cálculo del intervalo de tolerancia
-    _x_tol = np.sqrt(1 / n + np.square((x - x_mean)) / ss)
-    _x_tol_grid = np.sqrt(1 / n + np.square((x_grid - x_mean)) / ss)
-    zp_d = st.norm.ppf(cobertura) / _x_tol
-    zp_d_grid = st.norm.ppf(cobertura) / _x_tol_grid
-    se_x_tol = sp.nctdtrit(n - 2, zp_d, nc, out=None) * mse * _x_tol
-    se_x_tol_grid = sp.nctdtrit(n - 2, zp_d_grid, nc, out=None) * mse * _x_tol_grid
-
-    # cálculo de predicción en x con nivel de confianza nc (ambos métodos e intervalo de tolerancia)
+    # cálculo de predicción en x y en el grid x_grid con nivel de confianza nc
+    # (ambos métodos)
     y_pred_nc_aprox = y_predict + se_x_aprox
     y_pred_nc = y_predict + se_x
-    y_tol_nc = y_predict + se_x_tol
+    y_predict_x_grid = intercept + slope * x_grid
+    y_pred_x_grid_nc_aprox = y_predict_x_grid + se_x_aprox
+    y_pred_x_grid_nc = y_predict_x_grid + se_x_grid
+
+    # cálculo del intervalo de tolerancia (opcional): una única llamada a
+    # nctdtrit para los puntos x y x_grid
+    if compute_tolerance:
+        x_tol_all = np.concatenate((_x_tol, _x_tol_grid))
+        se_tol_all = sp.nctdtrit(n - 2, z_cov / x_tol_all, nc) * mse * x_tol_all
+        y_tol_nc = y_predict + se_tol_all[:n]
+        y_tol_x_grid_nc = y_predict_x_grid + se_tol_all[n:]
 
     # cálculo de cobertura sobre la muestra con los tres modelos
-    cover_aprox = np.mean(y_pred_nc_aprox > y)
-    cover_pred = np.mean(y_pred_nc > y)
-    cover_tol = np.mean(y_tol_nc > y)
+    cover_aprox = np.count_nonzero(y_pred_nc_aprox > y) / n
+    cover_pred = np.count_nonzero(y_pred_nc > y) / n
+    cover_tol = np.count_nonzero(y_tol_nc > y) / n if compute_tolerance else None
     cover = (cover_aprox, cover_pred, cover_tol)
     print("la cobertura sobre la muestra de los modelos (aprox/pred/toler) es ", cover)
 
-    # se repiten los cálculos para el grid x_grid
-    y_predict_x_grid = intercept + slope * x_grid
-    y_pred_x_grid_nc_aprox = y_predict_x_grid + se_x_aprox
-    y_pred_x_grid_nc = y_predict_x_grid + se_x_grid
-    y_tol_x_grid_nc = y_predict_x_grid + se_x_tol_grid
-
     # ajuste aproximado: recta de seguridad con nc
     nc_equation_aprox = (intercept + se_x_aprox, slope)
-    # ajuste del intervalo de predicción a una ecuación de segundo grado
-    nc_equation_pred = np.polyfit(x_grid, y_pred_x_grid_nc, deg=2, full="true")
-    # ajuste del intervalo de tolerancia a una ecuación de segundo grado
-    nc_equation_tol = np.polyfit(x_grid, y_tol_x_grid_nc, deg=2, full="true")
-
-    # gráfico de resultados
-    plt.figure(0)
-    _ = plt.plot(x, y, marker=".", linestyle="none", label="data")
-    plt.plot(x_grid, y_predict_x_grid, linestyle="solid", label="regression")
-    plt.plot(x_grid, y_pred_x_grid_nc_aprox, linestyle="dashed", label="nc_aprox")
-    plt.plot(x_grid, y_pred_x_grid_nc, linestyle="solid", label="prediction")
-    plt.plot(x_grid, y_tol_x_grid_nc, linestyle="solid", label="tolerance")
-    plt.legend()
-    # Label axes
-    _ = plt.xlabel("log(sd)")
-    _ = plt.ylabel("log(ppv)")
-    plt.margins(0.05)
-
-    # guardado de resultados en los puntos x
-    df_x["y_pred"] = y_predict
-    df_x["y_pred_nc_aprox"] = y_pred_nc_aprox
-    df_x["y_pred_nc"] = y_pred_nc
-    df_x["y_tol_nc"] = y_tol_nc
-
-    # guardado de resultados en los puntos x_grid
-    df_x_grid = pd.DataFrame({"x": x_grid})
-    df_x_grid["y_pred"] = y_predict_x_grid
-    df_x_grid["y_pred_nc_aprox"] = y_pred_x_grid_nc_aprox
-    df_x_grid["y_pred_nc"] = y_pred_x_grid_nc
-    df_x_grid["y_tol_nc"] = y_tol_x_grid_nc
+    # ajuste de los intervalos de predicción y de tolerancia a una ecuación de
+    # segundo grado: ecuaciones normales (3x3) resueltas una vez por grid
+    fit_grid = _vander_fit(x_grid[0], x_grid[-1], ngrid)
+    nc_equation_pred = fit_grid @ y_pred_x_grid_nc
+    nc_equation_tol = fit_grid @ y_tol_x_grid_nc if compute_tolerance else None
+
+    # gráfico de resultados (matplotlib solo se importa si se grafica)
+    if plot:
+        import matplotlib.pyplot as plt
+
+        # se reutiliza (vaciada) la figura 0 en cada llamada
+        _, ax = plt.subplots(num=0, clear=True)
+        ax.plot(x, y, marker=".", linestyle="none", label="data")
+        ax.plot(x_grid, y_predict_x_grid, linestyle="solid", label="regression")
+        ax.plot(x_grid, y_pred_x_grid_nc_aprox, linestyle="dashed", label="nc_aprox")
+        ax.plot(x_grid, y_pred_x_grid_nc, linestyle="solid", label="prediction")
+        if compute_tolerance:
+            ax.plot(x_grid, y_tol_x_grid_nc, linestyle="solid", label="tolerance")
+        ax.legend()
+        # Label axes
+        ax.set_xlabel("log(sd)")
+        ax.set_ylabel("log(ppv)")
+        ax.margins(0.05)
+
+    # guardado de resultados en los puntos x y x_grid
+    res_x = {
+        "x": x,
+        "y": y,
+        "y_pred": y_predict,
+        "y_pred_nc_aprox": y_pred_nc_aprox,
+        "y_pred_nc": y_pred_nc,
+    }
+    res_x_grid = {
+        "x": x_grid,
+        "y_pred": y_predict_x_grid,
+        "y_pred_nc_aprox": y_pred_x_grid_nc_aprox,
+        "y_pred_nc": y_pred_x_grid_nc,
+    }
+    if compute_tolerance:
+        res_x["y_tol_nc"] = y_tol_nc
+        res_x_grid["y_tol_nc"] = y_tol_x_grid_nc
+    df_x = pd.DataFrame(res_x)
+    df_x_grid = pd.DataFrame(res_x_grid)
     print(df_x_grid)
-    return nc_equation_pred[0], nc_equation_aprox, nc_equation_tol[0]
+    return nc_equation_pred, nc_equation_aprox, nc_equation_tol
+
+
+def _cargas(d_grid, logsd, beta):
+    """
+    Returns the charges Q = (D/sd)^(1/beta) at the distances d_grid for the
+    scaled distance sd = 10^logsd. The usual beta = 1/2 and beta = 1/3 laws
+    are computed with products instead of a generic power.
+    """
+    sd = math.exp(logsd * _LN10)
+    ratio = d_grid / sd
+    inv_beta = 1.0 / beta
+    if inv_beta == 2.0:
+        return ratio * ratio
+    if inv_beta == 3.0:
+        return ratio * ratio * ratio
+    return np.power(ratio, inv_beta)
 
 
 # función auxiliar para crear una tabla de carga operante frente a distancia a
@@ -183,7 +296,8 @@ def cargas_sd(
     nc_equation_tol,
     ppvumbral=40,
     beta=0.5,
-    d_grid=np.linspace(50, 250, 20),
+    d_grid=None,
+    plot=True,
 ):
     """
     Calculate the maximum cooperating charges (e.g., kg) as a function of distances
@@ -193,54 +307,61 @@ def cargas_sd(
     Parameters:
     nc_equation_pred (list or tuple): Coefficients of the prediction interval quadratic equation.
     nc_equation_aprox (list or tuple): Coefficients of the approximate model's linear equation.
-    nc_equation_tol (list or tuple): Coefficients of the tolerance interval quadratic equation.
+    nc_equation_tol (list or tuple): Coefficients of the tolerance interval quadratic equation,
+    or None to skip the tolerance solution.
+    d_grid (np.ndarray): Distances (default is 20 points between 50 and 250).
+    plot (bool): Whether to plot the results (default is True).
     Returns:
     pd.DataFrame: DataFrame containing distances (D) and calculated loads (Q).
     """
 
-    # resolución de la ecuación de segundo grado para resolución con intervalo de predicción
+    if d_grid is None:
+        d_grid = _DEFAULT_D_GRID
+
+    # el intervalo de tolerancia es opcional en ppv_regress
+    tolerancia = nc_equation_tol is not None
+
+    # resolución de las ecuaciones de segundo grado de los intervalos de
+    # predicción y de tolerancia a la vez (coeficientes a, b, c por filas)
     logppv = np.log10(ppvumbral)
-    a = nc_equation_pred[0]
-    b = nc_equation_pred[1]
-    c = nc_equation_pred[2] - logppv
+    ecuaciones = (
+        (nc_equation_pred, nc_equation_tol) if tolerancia else (nc_equation_pred,)
+    )
+    a, b, c = np.column_stack(ecuaciones)
+    c = c - logppv
     # raíz menor
-    logsd_pred = (-b - np.sqrt((b * b) - 4 * a * c)) / (2 * a)
-    sd_pred = 10**logsd_pred
-    # cálculo de las cargas para la solución con intervalo de predicción
-    cargas_prediccion = np.power(d_grid / sd_pred, 1 / beta)
+    logsd = (-b - np.sqrt((b * b) - 4 * a * c)) / (2 * a)
 
-    # cálculo de las cargas para solución aproximada
+    # cálculo de las cargas para las soluciones con intervalo de predicción,
+    # aproximada y con intervalo de tolerancia
     logsd_aprox = (-nc_equation_aprox[0] + logppv) / nc_equation_aprox[1]
-    sd_aprox = 10**logsd_aprox
-    carga_aprox = np.power(d_grid / sd_aprox, 1 / beta)
-
-    # resolución de la ecuación de segundo grado para solución con intervalo de tolerancia
-    a = nc_equation_tol[0]
-    b = nc_equation_tol[1]
-    c = nc_equation_tol[2] - logppv
-    # raíz menor
-    logsd_tol = (-b - np.sqrt((b * b) - 4 * a * c)) / (2 * a)
-    sd_tol = 10**logsd_tol
-    # cálculo de las cargas para la solución con intervalo de tolerancia
-    cargas_tolerancia = np.power(d_grid / sd_tol, 1 / beta)
-
-    # gráfico de resultados
-    plt.figure(1)
-    _ = plt.plot(d_grid, cargas_prediccion, linestyle="solid", label="Qpred vs D")
-    plt.plot(d_grid, carga_aprox, linestyle="dashed", label="Qaprox vs D")
-    plt.plot(d_grid, cargas_tolerancia, linestyle="solid", label="Qtol vs D")
-    plt.legend()
-
-    # Label axes
-    _ = plt.xlabel("Distancia")
-    _ = plt.ylabel("Carga")
-    plt.margins(0.05)
+    cargas_prediccion = _cargas(d_grid, logsd[0], beta)
+    carga_aprox = _cargas(d_grid, logsd_aprox, beta)
+    if tolerancia:
+        cargas_tolerancia = _cargas(d_grid, logsd[1], beta)
+
+    # gráfico de resultados (matplotlib solo se importa si se grafica)
+    if plot:
+        import matplotlib.pyplot as plt
+
+        # se reutiliza (vaciada) la figura 1 en cada llamada
+        _, ax = plt.subplots(num=1, clear=True)
+        ax.plot(d_grid, cargas_prediccion, linestyle="solid", label="Qpred vs D")
+        ax.plot(d_grid, carga_aprox, linestyle="dashed", label="Qaprox vs D")
+        if tolerancia:
+            ax.plot(d_grid, cargas_tolerancia, linestyle="solid", label="Qtol vs D")
+        ax.legend()
+
+        # Label axes
+        ax.set_xlabel("Distancia")
+        ax.set_ylabel("Carga")
+        ax.margins(0.05)
 
     # se almacenan los resultados en un dataframe
-    df_QvsD = pd.DataFrame({"D": d_grid})
-    df_QvsD["Q_prediccion"] = cargas_prediccion
-    df_QvsD["Qaprox"] = carga_aprox
-    df_QvsD["Qtolerancia"] = cargas_tolerancia
+    res_QvsD = {"D": d_grid, "Q_prediccion": cargas_prediccion, "Qaprox": carga_aprox}
+    if tolerancia:
+        res_QvsD["Qtolerancia"] = cargas_tolerancia
+    df_QvsD = pd.DataFrame(res_QvsD)
 
     return df_QvsD
 